@@ -1,7 +1,25 @@
 import streamlit as st
-import openai
+from openai import OpenAI, AsyncOpenAI
+import httpx
 import os
+import re
 import json
+import logging
+import orjson
+from partial_json_parser import loads as loads_partial_json, Allow
+import asyncio
+import concurrent.futures
+import base64
+import hashlib
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
 
 # Configure OpenRouter API - using streamlit secrets for deployment
 # try:
@@ -10,10 +28,39 @@ import json
 # except:
     # Fall back to environment variable (for local development)
 api_key = os.getenv("OPENROUTER_API_KEY")
+openai_api_key = os.getenv("OPENAI_API_KEY")
+
+# OpenRouter exposes an OpenAI-compatible API
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+# Keep connections open between calls to skip repeated TCP/TLS handshakes
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=20)
+
+@st.cache_resource
+def get_http_client():
+    """HTTP/2 connection pool shared by every sync client, across reruns and sessions"""
+    return httpx.Client(http2=True, limits=HTTP_LIMITS)
+
+@st.cache_resource
+def get_client():
+    """OpenAI client pointed at OpenRouter"""
+    return OpenAI(base_url=OPENROUTER_BASE_URL, api_key=api_key, http_client=get_http_client())
+
+@st.cache_resource
+def get_batch_client():
+    """OpenAI client for the Batch API, which OpenRouter does not proxy"""
+    return OpenAI(api_key=openai_api_key, http_client=get_http_client())
 
-# Configure OpenAI client for older version (0.28.1)
-openai.api_key = api_key
-openai.api_base = "https://openrouter.ai/api/v1"
+def get_async_client():
+    """Create an async OpenAI client pointed at OpenRouter, retrying rate-limited calls"""
+    # Async connections are bound to their event loop, so each asyncio.run gets its own
+    # client; over HTTP/2 all of its concurrent requests share one connection
+    return AsyncOpenAI(
+        base_url=OPENROUTER_BASE_URL,
+        api_key=api_key,
+        max_retries=3,
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+    )
 
 # App configuration
 st.set_page_config(
@@ -36,6 +83,46 @@ model_options = [
     "mistralai/mistral-7b-instruct:free"
 ]
 selected_model = st.sidebar.selectbox("Select Model", model_options)
+# Coalesced analyses are answered by batch prompts, which skip the semantic cache;
+# read the "Coalesce requests" toggle below through its key to reflect that here
+coalescing = st.session_state.get("coalesce_requests", False)
+use_semantic_cache = st.sidebar.checkbox(
+    "Use semantic cache",
+    value=True,
+    disabled=coalescing,
+    key="use_semantic_cache",
+    # Keep help constant: it is part of the widget's identity, and a new identity resets the value
+    help="Not used while coalescing requests"
+) and not coalescing
+semantic_threshold = st.sidebar.slider(
+    "Semantic cache threshold",
+    min_value=0.80,
+    max_value=1.00,
+    value=0.92,
+    step=0.01,
+    disabled=not use_semantic_cache
+)
+bulk_mode = st.sidebar.checkbox(
+    "Bulk mode",
+    help="Submit bulk analyses to the OpenAI Batch API: about half the cost, results within 24 hours"
+)
+coalesce_requests = st.sidebar.checkbox(
+    "Coalesce requests",
+    key="coalesce_requests",
+    help="Merge analyses submitted within a short window (from any session) into one batch-prompt call. Results are not streamed and the semantic cache is skipped."
+)
+coalesce_batch_size = st.sidebar.number_input(
+    "Coalesce batch size",
+    min_value=1, max_value=25, value=8,
+    disabled=not coalesce_requests,
+    help="Applies to batches your requests start"
+)
+coalesce_wait_ms = st.sidebar.slider(
+    "Coalesce window (ms)",
+    min_value=50, max_value=2000, value=500, step=50,
+    disabled=not coalesce_requests,
+    help="Applies to batches your requests start"
+)
 
 # Team assignment mapping
 TEAM_ASSIGNMENTS = {
@@ -48,23 +135,21 @@ TEAM_ASSIGNMENTS = {
     "Other": "To be assigned"
 }
 
-# Your analysis prompt template
-ANALYSIS_PROMPT = """
-You are an expert at analyzing companies in the education sector. 
+# Static analysis instructions, sent as the system message. Keep this byte-identical
+# across calls so providers can serve it from their prompt prefix cache.
+SYSTEM_PROMPT = """
+You are an expert at analyzing companies in the education sector. Always respond with valid JSON.
 
-Please analyze the following company and categorize it based on which sector of education their products and services serve:
-
-Company: {company_name}
-Description: {company_description}
+Analyze the company you are given and categorize it based on which sector of education their products and services serve.
 
 Please provide your analysis in the following JSON format:
-{{
+{
     "company_name": "Company Name",
     "primary_sectors": ["list of primary education sectors"],
     "secondary_sectors": ["list of secondary education sectors"],
-    "reasoning": "Brief explanation of your analysis",
+    "reasoning": "One-sentence explanation of your analysis",
     "confidence": "High/Medium/Low"
-}}
+}
 
 Education sector categories:
 - K-12: Elementary, middle, and high school education
@@ -73,74 +158,811 @@ Education sector categories:
 - Corporate Development: Leadership development, executive education
 - Other: EdTech tools, platforms, or services that don't fit above categories
 
-Be specific and provide clear reasoning for your categorization.
+Be specific, and keep the reasoning to a single sentence.
+"""
+
+# Per-company user message
+ANALYSIS_PROMPT = """Company: {company_name}
+Description: {company_description}"""
+
+# Shorter instructions for small models, which know the sectors without descriptions
+TERSE_SYSTEM_PROMPT = """
+Categorize each education company you are given. Respond with only JSON, using this object per company:
+{"company_name": "Company Name", "primary_sectors": [], "secondary_sectors": [], "reasoning": "One sentence", "confidence": "High/Medium/Low"}
+Sectors: K-12, Higher Education, Workforce Learning, Corporate Development, Other.
 """
 
+TERSE_ANALYSIS_PROMPT = """Company: {company_name}
+Description: {company_description}
+Respond with the JSON object only."""
+
+def split_prompt(template):
+    """Pre-split a user prompt template around its two fields so building a prompt is plain concatenation"""
+    pre, rest = template.split("{company_name}", 1)
+    mid, suf = rest.split("{company_description}", 1)
+    return pre, mid, suf
+
+# (system prompt, user prefix, user middle, user suffix) per model
+FULL_PROMPT = (SYSTEM_PROMPT, *split_prompt(ANALYSIS_PROMPT))
+TERSE_PROMPT = (TERSE_SYSTEM_PROMPT, *split_prompt(TERSE_ANALYSIS_PROMPT))
+
+PROMPTS = {
+    "openai/gpt-4o": FULL_PROMPT,
+    "meta-llama/llama-3.2-3b-instruct:free": TERSE_PROMPT,
+    "microsoft/phi-3-mini-128k-instruct:free": TERSE_PROMPT,
+    "google/gemma-2-9b-it:free": TERSE_PROMPT,
+    "mistralai/mistral-7b-instruct:free": TERSE_PROMPT
+}
+
+# Batch user message for analyzing several companies in one call
+BATCH_ANALYSIS_PROMPT = """Analyze each of the following companies:
+
+{company_list}
+
+Respond with a JSON array containing exactly one analysis object per company, in the same order as listed above."""
+
+# Sector groups used for team assignment
+_MITCH_SECTORS = frozenset({"K-12", "Higher Education"})
+_SAM_SECTORS = frozenset({"Workforce Learning", "Corporate Development"})
+
 def get_team_assignment(sectors):
     """Determine team assignment based on education sectors"""
     if not sectors:
         return "To be assigned"
     
-    # Convert to set for easier matching
-    sector_set = set(sectors)
+    # Most analyses have a single sector
+    if len(sectors) == 1:
+        sector = sectors[0]
+        if sector in _MITCH_SECTORS:
+            return "Mitch"
+        if sector in _SAM_SECTORS:
+            return "Sam"
+        return "To be assigned"
+    
+    sector_set = frozenset(sectors)
     
     # Check for combinations
-    if {"K-12", "Higher Education"}.issubset(sector_set):
+    if _MITCH_SECTORS <= sector_set:
         return "Mitch"
-    elif {"Workforce Learning", "Corporate Development"}.issubset(sector_set):
+    elif _SAM_SECTORS <= sector_set:
         return "Sam"
-    elif "K-12" in sector_set or "Higher Education" in sector_set:
+    elif not _MITCH_SECTORS.isdisjoint(sector_set):
         return "Mitch"
-    elif "Workforce Learning" in sector_set or "Corporate Development" in sector_set:
+    elif not _SAM_SECTORS.isdisjoint(sector_set):
         return "Sam"
     else:
         return "To be assigned"
 
-def analyze_company(company_name, company_description, model):
-    """Analyze company using OpenRouter API"""
+# Response cache settings
+CACHE_MAX_ENTRIES = 1000
+DB_PATH = "analyses.db"
+
+def get_cache_key(model, company_name, company_description):
+    """Build a stable cache key for an analysis request"""
+    return hashlib.sha256(f"{model}|{company_name}|{company_description}".encode()).hexdigest()
+
+@st.cache_resource
+def get_db():
+    """Open the SQLite store backing the cache and history, shared across sessions"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS analyses "
+        "(key TEXT PRIMARY KEY, company TEXT, model TEXT, json TEXT, ts INTEGER)"
+    )
+    conn.commit()
+    return conn
+
+@st.cache_resource
+def get_db_lock():
+    """Serialize access to the shared SQLite connection"""
+    return threading.Lock()
+
+@st.cache_resource
+def get_response_cache():
+    """In-memory LRU of analyses, shared across sessions"""
+    return OrderedDict()
+
+@st.cache_resource
+def get_response_cache_lock():
+    """Serialize access to the shared in-memory LRU"""
+    return threading.Lock()
+
+def remember_analysis(key, analysis):
+    """Keep an analysis in the in-memory LRU"""
+    cache = get_response_cache()
+    with get_response_cache_lock():
+        cache[key] = analysis
+        cache.move_to_end(key)
+        while len(cache) > CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+def get_cached_analysis(key):
+    """Look up an analysis in memory first, then in SQLite, ignoring low-confidence results"""
+    cache = get_response_cache()
+    with get_response_cache_lock():
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    
     try:
-        # Format the prompt
-        prompt = ANALYSIS_PROMPT.format(
-            company_name=company_name,
-            company_description=company_description or "No description provided"
-        )
+        with get_db_lock():
+            row = get_db().execute("SELECT json FROM analyses WHERE key = ?", (key,)).fetchone()
+    except Exception:
+        return None
+    if row is None:
+        return None
+    
+    analysis = orjson.loads(row[0])
+    if analysis.get('confidence') == "Low":
+        return None
+    remember_analysis(key, analysis)
+    return analysis
+
+def store_analysis(key, company_name, model, analysis):
+    """Save an analysis to SQLite, caching it in memory unless it is low-confidence"""
+    if analysis.get('confidence') != "Low":
+        remember_analysis(key, analysis)
+    
+    try:
+        with get_db_lock():
+            conn = get_db()
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, company, model, json, ts) VALUES (?, ?, ?, ?, ?)",
+                (key, analysis.get('company_name') or company_name, model, orjson.dumps(analysis).decode(), int(time.time()))
+            )
+            conn.commit()
+    except Exception:
+        pass
+    
+    # The history panel reads from a cached query; refresh it for every session
+    get_recent_analyses.clear()
+
+@st.cache_data
+def get_recent_analyses(limit=10):
+    """Return the latest analysis of each of the most recently analyzed companies"""
+    with get_db_lock():
+        rows = get_db().execute(
+            "SELECT json, MAX(ts) FROM analyses GROUP BY company ORDER BY MAX(ts) DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+    return [orjson.loads(row[0]) for row in rows]
+
+# Known-company classifier settings
+KNOWN_COMPANIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "known_companies.csv")
+KNOWN_MATCH_THRESHOLD = 0.9
+
+def normalize_company_name(name):
+    """Lowercase a company name and drop punctuation and legal suffixes for matching"""
+    name = re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
+    return re.sub(r"\s+(inc|llc|ltd|corp|corporation|co)$", "", name)
+
+@st.cache_resource
+def get_known_companies():
+    """Load the known-company list and fit a TF-IDF index over the names"""
+    companies = pd.read_csv(KNOWN_COMPANIES_PATH).fillna("")
+    names = [normalize_company_name(name) for name in companies['name']]
+    analyses = [
+        {
+            "company_name": row['name'],
+            "primary_sectors": [sector for sector in row['primary_sectors'].split(";") if sector],
+            "secondary_sectors": [sector for sector in row['secondary_sectors'].split(";") if sector],
+            "reasoning": "Matched a known company in the local company list",
+            "confidence": row['confidence'],
+            "source": "local"
+        }
+        for _, row in companies.iterrows()
+    ]
+    
+    # Character n-grams tolerate punctuation and small spelling differences in names
+    vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4))
+    matrix = vectorizer.fit_transform(names)
+    return {
+        "exact": dict(zip(names, analyses)),
+        "names": names,
+        "analyses": analyses,
+        "vectorizer": vectorizer,
+        "matrix": matrix
+    }
+
+def classify_known_company(company_name, company_description):
+    """Answer a name-only request from the known-company list, or None to fall through to the LLM"""
+    if company_description:
+        return None
+    
+    try:
+        known = get_known_companies()
+    except Exception:
+        return None
+    
+    name = normalize_company_name(company_name)
+    if name in known["exact"]:
+        return known["exact"][name]
+    
+    # TF-IDF rows are L2-normalized, so the dot product is cosine similarity
+    scores = (known["matrix"] @ known["vectorizer"].transform([name]).T).toarray().ravel()
+    best = int(scores.argmax())
+    if scores[best] < KNOWN_MATCH_THRESHOLD:
+        return None
+    
+    # A known name plus extra words is usually a sub-brand or a different company
+    if set(known["names"][best].split()) < set(name.split()):
+        return None
+    
+    # Near matches may be spelled differently; keep the name the user entered
+    return {**known["analyses"][best], "company_name": company_name}
+
+# Semantic cache settings
+EMBEDDING_MODEL = "openai/text-embedding-3-small"
+# One JSON line per entry (model, base64 float32 vector, analysis), appended as entries are added
+SEMANTIC_CACHE_PATH = "semantic_cache.jsonl"
+
+# Rows added to a model's vector matrix each time it fills up
+SEMANTIC_GROWTH_ROWS = 64
+
+def add_semantic_vector(bucket, vector, analysis):
+    """Append a normalized vector and its analysis to a model's bucket"""
+    if bucket["matrix"] is None:
+        bucket["matrix"] = np.zeros((SEMANTIC_GROWTH_ROWS, vector.shape[0]), dtype=np.float32)
+    elif bucket["count"] == len(bucket["matrix"]):
+        # Grow in chunks to amortize reallocation
+        bucket["matrix"] = np.vstack([
+            bucket["matrix"],
+            np.zeros((SEMANTIC_GROWTH_ROWS, vector.shape[0]), dtype=np.float32)
+        ])
+    bucket["matrix"][bucket["count"]] = vector
+    bucket["count"] += 1
+    bucket["analyses"].append(analysis)
+
+@st.cache_resource
+def get_semantic_cache_lock():
+    """Serialize access to the shared semantic cache so vectors stay aligned with analyses"""
+    return threading.Lock()
+
+@st.cache_resource
+def get_semantic_cache():
+    """Load stored embeddings into one L2-normalized matrix per model, shared across sessions"""
+    cache = {}
+    try:
+        with open(SEMANTIC_CACHE_PATH, "rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                    vector = np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32)
+                except Exception:
+                    # A crash mid-append can leave a partial last line
+                    continue
+                
+                # A zero vector can't be normalized or matched; skip it
+                norm = np.linalg.norm(vector)
+                if norm == 0:
+                    continue
+                bucket = cache.setdefault(entry["model"], {"matrix": None, "count": 0, "analyses": []})
+                add_semantic_vector(bucket, vector / norm, entry["analysis"])
+    except OSError:
+        pass
+    return cache
+
+def get_embedding(text):
+    """Embed text for semantic cache lookups, L2-normalized so dot products are cosine similarities"""
+    response = get_client().embeddings.create(model=EMBEDDING_MODEL, input=text)
+    embedding = np.array(response.data[0].embedding, dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    if norm == 0:
+        raise ValueError("Embedding has zero norm")
+    return embedding / norm
+
+def find_similar_analysis(embedding, model, threshold):
+    """Return the cached analysis most similar to embedding if above threshold"""
+    with get_semantic_cache_lock():
+        bucket = get_semantic_cache().get(model)
+        if not bucket or not bucket["count"]:
+            return None
         
-        # Make API call using older OpenAI library syntax
-        response = openai.ChatCompletion.create(
+        # One matrix-vector product scores every cached analysis for this model
+        scores = bucket["matrix"][:bucket["count"]] @ embedding
+        best = int(scores.argmax())
+        if scores[best] >= threshold:
+            return bucket["analyses"][best]
+        return None
+
+def store_semantic_analysis(embedding, model, analysis):
+    """Add an analysis to the semantic cache and persist it"""
+    if analysis.get('confidence') == "Low":
+        return
+    
+    with get_semantic_cache_lock():
+        cache = get_semantic_cache()
+        bucket = cache.setdefault(model, {"matrix": None, "count": 0, "analyses": []})
+        add_semantic_vector(bucket, embedding, analysis)
+        
+        # Append only the new entry; a partial line left by a crash is skipped on load
+        line = orjson.dumps({
+            "model": model,
+            "vector": base64.b64encode(embedding.astype(np.float32).tobytes()).decode(),
+            "analysis": analysis
+        }) + b"\n"
+        try:
+            with open(SEMANTIC_CACHE_PATH, "ab") as f:
+                f.write(line)
+        except OSError:
+            pass
+
+def build_system_message(model):
+    """Build the static system message, marked cacheable for providers that need it"""
+    system_prompt = PROMPTS.get(model, FULL_PROMPT)[0]
+    if model.startswith("anthropic/"):
+        # Anthropic only caches prompt prefixes that are explicitly marked
+        return {
+            "role": "system",
+            "content": [
+                {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
+            ]
+        }
+    return {"role": "system", "content": system_prompt}
+
+def build_messages(company_name, company_description, model):
+    """Build the chat messages for analyzing a single company"""
+    _, pre, mid, suf = PROMPTS.get(model, FULL_PROMPT)
+    prompt = pre + company_name + mid + (company_description or "No description provided") + suf
+    return [
+        build_system_message(model),
+        {"role": "user", "content": prompt}
+    ]
+
+# An analysis object is ~150 tokens; a tight budget keeps responses short
+ANALYSIS_MAX_TOKENS = 220
+
+def supports_json_mode(model):
+    """Whether the model accepts response_format={"type": "json_object"}"""
+    return "gpt" in model
+
+def completion_options(model):
+    """Token budget and response format for a single-company analysis"""
+    options = {"max_tokens": ANALYSIS_MAX_TOKENS, "temperature": 0.3}
+    if supports_json_mode(model):
+        options["response_format"] = {"type": "json_object"}
+    return options
+
+def sector_list(value):
+    """Coerce a model-supplied sectors field to a list of strings"""
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+    return [str(sector) for sector in value if sector]
+
+def parse_analysis(content, company_name, model):
+    """Extract the analysis JSON from a model response"""
+    try:
+        if supports_json_mode(model):
+            # JSON mode guarantees the whole response is the object
+            analysis = orjson.loads(content)
+        else:
+            # Find JSON in response
+            analysis = orjson.loads(content[content.index('{'):content.rindex('}') + 1])
+        if isinstance(analysis, dict):
+            # Stored analyses are shared, so don't let a malformed reply reach the store
+            analysis["primary_sectors"] = sector_list(analysis.get("primary_sectors"))
+            analysis["secondary_sectors"] = sector_list(analysis.get("secondary_sectors"))
+            analysis["source"] = "llm"
+            return analysis
+    except Exception:
+        pass
+    
+    # If JSON parsing fails, return structured response
+    return {
+        "company_name": company_name,
+        "primary_sectors": ["Other"],
+        "secondary_sectors": [],
+        "reasoning": content,
+        "confidence": "Low",
+        "source": "llm"
+    }
+
+def lookup_analysis(cache_key, company_name, company_description, model):
+    """Answer a request from the cache or the known-company list, or None if it needs the LLM"""
+    cached = get_cached_analysis(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Answer well-known companies from the local list without an API call
+    local = classify_known_company(company_name, company_description)
+    if local is not None:
+        store_analysis(cache_key, company_name, model, local)
+    return local
+
+# Fields shown while an analysis streams in, in the order the model emits them
+STREAMED_FIELDS = {
+    "company_name": "Company",
+    "primary_sectors": "Primary",
+    "secondary_sectors": "Secondary",
+    "reasoning": "Reasoning",
+    "confidence": "Confidence"
+}
+
+def analyze_company(company_name, company_description, model, placeholder=None, semantic_threshold=None, raise_errors=False):
+    """Analyze company using OpenRouter API, streaming tokens into placeholder"""
+    try:
+        # Return a previous or known answer for the same request if we have one
+        cache_key = get_cache_key(model, company_name, company_description)
+        known = lookup_analysis(cache_key, company_name, company_description, model)
+        if known is not None:
+            return known
+        
+        # Reuse the analysis of a near-duplicate request if one is close enough
+        embedding = None
+        if semantic_threshold is not None:
+            try:
+                embedding = get_embedding(f"{company_name} {company_description or ''}".strip())
+                similar = find_similar_analysis(embedding, model, semantic_threshold)
+                if similar is not None:
+                    return similar
+            except Exception:
+                embedding = None
+        
+        response = get_client().chat.completions.create(
             model=model,
-            messages=[
-                {"role": "system", "content": "You are an expert education sector analyst. Always respond with valid JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500,
-            temperature=0.3
+            messages=build_messages(company_name, company_description, model),
+            stream=True,
+            stream_options={"include_usage": True},
+            **completion_options(model)
         )
         
-        # Parse response
-        content = response.choices[0].message.content
+        # One slot per field, filled in as each field completes in the stream
+        field_slots = {}
+        if placeholder is not None:
+            with placeholder.container():
+                field_slots = {field: st.empty() for field in STREAMED_FIELDS}
         
-        # Try to extract JSON from response
-        try:
-            # Find JSON in response
+        # Accumulate streamed tokens, rendering fields as they arrive
+        content = ""
+        usage = None
+        finish_reason = None
+        shown = {}
+        for chunk in response:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            delta = chunk.choices[0].delta.content or ""
+            content += delta
+            
+            # A field can only have completed on a closing quote or bracket
+            if not field_slots or not any(c in delta for c in '"]}'):
+                continue
             start = content.find('{')
-            end = content.rfind('}') + 1
-            json_str = content[start:end]
-            analysis = json.loads(json_str)
-            return analysis
-        except:
-            # If JSON parsing fails, return structured response
-            return {
-                "company_name": company_name,
-                "primary_sectors": ["Other"],
-                "secondary_sectors": [],
-                "reasoning": content,
-                "confidence": "Low"
-            }
+            if start == -1:
+                continue
+            try:
+                # Only objects and arrays may be incomplete, so strings show once closed
+                partial = loads_partial_json(content[start:], Allow.OBJ | Allow.ARR)
+            except Exception:
+                continue
+            if not isinstance(partial, dict):
+                continue
+            for field, label in STREAMED_FIELDS.items():
+                value = partial.get(field)
+                if value and value != shown.get(field):
+                    shown[field] = value
+                    text = ", ".join(map(str, value)) if isinstance(value, list) else value
+                    field_slots[field].markdown(f"**{label}:** {text}")
+        
+        # Clear the streamed fields once the full response is in
+        if placeholder is not None:
+            placeholder.empty()
+        
+        # Log how much of the prompt was served from the provider's prefix cache
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", None) or 0
+            logger.info("%s prompt tokens: %s (%s cached)", model, usage.prompt_tokens, cached_tokens)
+        
+        # A reply cut off at max_tokens is incomplete JSON; don't record it as an analysis
+        if finish_reason == "length":
+            raise ValueError("the model's response was cut off before the analysis was complete")
+        
+        analysis = parse_analysis(content, company_name, model)
+        store_analysis(cache_key, company_name, model, analysis)
+        if embedding is not None:
+            store_semantic_analysis(embedding, model, analysis)
+        return analysis
             
     except Exception as e:
+        # Callers off the script thread can't show st.error, so they get the exception instead
+        if raise_errors:
+            raise
         st.error(f"Error analyzing company: {str(e)}")
         return None
 
+def analyze_companies_batch(rows, model, b=10, return_exceptions=False):
+    """Analyze (name, description) rows, packing up to b companies into each API call"""
+    results = [None] * len(rows)
+    
+    # Serve what we can from the cache and known-company list, and batch up the rest
+    pending = []
+    for i, (name, description) in enumerate(rows):
+        results[i] = lookup_analysis(get_cache_key(model, name, description), name, description, model)
+        if results[i] is None:
+            pending.append(i)
+    
+    for chunk_start in range(0, len(pending), b):
+        chunk = pending[chunk_start:chunk_start + b]
+        company_list = "\n".join(
+            f"{n}) {rows[i][0]}: {rows[i][1] or 'No description provided'}"
+            for n, i in enumerate(chunk, start=1)
+        )
+        
+        analyses = None
+        try:
+            response = get_client().chat.completions.create(
+                model=model,
+                messages=[
+                    build_system_message(model),
+                    {"role": "user", "content": BATCH_ANALYSIS_PROMPT.format(company_list=company_list)}
+                ],
+                max_tokens=ANALYSIS_MAX_TOKENS * len(chunk),
+                temperature=0.3
+            )
+            content = response.choices[0].message.content
+            if response.choices[0].finish_reason == "length":
+                raise ValueError("Truncated batch response")
+            first_object, first_array = content.find('{'), content.find('[')
+            if len(chunk) == 1 and first_object != -1 and (first_array == -1 or first_object < first_array):
+                # A lone company is often answered with the bare object the system prompt describes
+                analyses = [orjson.loads(content[first_object:content.rindex('}') + 1])]
+            else:
+                analyses = orjson.loads(content[first_array:content.rindex(']') + 1])
+        except Exception:
+            analyses = None
+        
+        # Fall back to one call per company if the batch response doesn't line up
+        if not isinstance(analyses, list) or len(analyses) != len(chunk) or not all(isinstance(a, dict) for a in analyses):
+            # With return_exceptions, a failed company gets its exception in place of a result
+            for i in chunk:
+                try:
+                    results[i] = analyze_company(rows[i][0], rows[i][1], model, raise_errors=return_exceptions)
+                except Exception as e:
+                    results[i] = e
+            continue
+        
+        for i, analysis in zip(chunk, analyses):
+            analysis["primary_sectors"] = sector_list(analysis.get("primary_sectors"))
+            analysis["secondary_sectors"] = sector_list(analysis.get("secondary_sectors"))
+            analysis["source"] = "llm"
+            store_analysis(get_cache_key(model, rows[i][0], rows[i][1]), rows[i][0], model, analysis)
+            results[i] = analysis
+    
+    return results
+
+async def analyze_companies_concurrent(rows, model, max_concurrency=10):
+    """Analyze (name, description) rows with one API call each, max_concurrency at a time"""
+    sem = asyncio.Semaphore(max_concurrency)
+    
+    async with get_async_client() as client:
+        async def _one(name, description):
+            cache_key = get_cache_key(model, name, description)
+            known = lookup_analysis(cache_key, name, description, model)
+            if known is not None:
+                return known
+            
+            async with sem:
+                try:
+                    response = await client.chat.completions.create(
+                        model=model,
+                        messages=build_messages(name, description, model),
+                        **completion_options(model)
+                    )
+                    if response.choices[0].finish_reason == "length":
+                        return None
+                    content = response.choices[0].message.content
+                except Exception:
+                    return None
+            
+            analysis = parse_analysis(content, name, model)
+            store_analysis(cache_key, name, model, analysis)
+            return analysis
+        
+        return await asyncio.gather(*[_one(name, description) for name, description in rows])
+
+def submit_batch_job(rows, model):
+    """Upload (name, description) rows as a Batch API job and return its id"""
+    lines = [
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model.removeprefix("openai/"),
+                "messages": build_messages(name, description, model),
+                **completion_options(model)
+            }
+        })
+        for i, (name, description) in enumerate(rows)
+    ]
+    
+    client = get_batch_client()
+    batch_file = client.files.create(
+        file=("companies.jsonl", "\n".join(lines).encode()),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+def get_batch_error(batch):
+    """Return the first error message in a batch's error file, or None"""
+    if not batch.error_file_id:
+        return None
+    errors = get_batch_client().files.content(batch.error_file_id).text
+    for line in errors.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        # Errors are reported either on the record or in the response body
+        error = record.get("error") or ((record.get("response") or {}).get("body") or {}).get("error") or {}
+        if error.get("message"):
+            return error["message"]
+    return None
+
+def get_batch_results(batch, rows, model):
+    """Download a completed batch and parse one analysis per row"""
+    results = [None] * len(rows)
+    output = get_batch_client().files.content(batch.output_file_id).text
+    
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") != 200:
+            continue
+        
+        i = int(record["custom_id"])
+        name, description = rows[i]
+        choice = response["body"]["choices"][0]
+        if choice.get("finish_reason") == "length":
+            continue
+        content = choice["message"]["content"]
+        analysis = parse_analysis(content, name, model)
+        store_analysis(get_cache_key(model, name, description), name, model, analysis)
+        results[i] = analysis
+    
+    return results
+
+def render_analysis_table(analyses):
+    """Show bulk analysis results as a table"""
+    st.dataframe(pd.DataFrame([
+        {
+            "Company": analysis.get('company_name'),
+            "Primary": ", ".join(analysis.get('primary_sectors', [])),
+            "Secondary": ", ".join(analysis.get('secondary_sectors', [])),
+            "Assigned to": get_team_assignment(
+                analysis.get('primary_sectors', []) + analysis.get('secondary_sectors', [])
+            ),
+            "Confidence": analysis.get('confidence', 'Medium')
+        }
+        for analysis in analyses
+    ]))
+
+@st.fragment
+def render_team_rules():
+    """Show the static team assignment rules"""
+    st.header("Team Assignments")
+    st.write("**Current assignment rules:**")
+    
+    for sectors, member in TEAM_ASSIGNMENTS.items():
+        st.write(f"• {sectors} → {member}")
+
+@st.fragment
+def render_history():
+    """Show the most recently analyzed companies"""
+    try:
+        recent = get_recent_analyses(10)  # Show last 10
+    except Exception:
+        recent = []
+    if recent:
+        st.header("📈 Analysis History")
+        for analysis in recent:
+            # Rows stored before sectors were validated may hold anything
+            all_sectors = sector_list(analysis.get('primary_sectors')) + sector_list(analysis.get('secondary_sectors'))
+            with st.expander(f"{analysis.get('company_name')} → {get_team_assignment(all_sectors)}"):
+                st.write(f"**Sectors:** {', '.join(all_sectors)}")
+                st.write(f"**Confidence:** {analysis.get('confidence', 'Medium')}")
+                st.write(f"**Source:** {'Known company list' if analysis.get('source') == 'local' else 'LLM'}")
+
+# Longest a caller waits for a coalesced analysis before giving up
+COALESCE_TIMEOUT_SECONDS = 120
+
+class RequestCoalescer:
+    """Merge analysis requests arriving within a short window into batch-prompt calls"""
+    
+    def __init__(self):
+        self.submitted = 0
+        self.batches = 0
+        self.loop = asyncio.new_event_loop()
+        self.queue = asyncio.Queue()
+        # The loop only keeps weak references to tasks, so hold them until they finish
+        self.tasks = set()
+        threading.Thread(target=self.loop.run_until_complete, args=(self._worker(),), daemon=True).start()
+    
+    async def submit(self, company_name, company_description, model, batch_size=8, wait_ms=500):
+        """Queue a company for analysis and wait for its result"""
+        future = self.loop.create_future()
+        self.submitted += 1
+        await self.queue.put({
+            "company_name": company_name,
+            "company_description": company_description,
+            "model": model,
+            "batch_size": batch_size,
+            "wait_ms": wait_ms,
+            "future": future
+        })
+        return await future
+    
+    def analyze(self, company_name, company_description, model, batch_size=8, wait_ms=500):
+        """Submit from a non-async caller, such as the Streamlit script thread"""
+        future = asyncio.run_coroutine_threadsafe(
+            self.submit(company_name, company_description, model, batch_size, wait_ms), self.loop
+        )
+        try:
+            return future.result(timeout=COALESCE_TIMEOUT_SECONDS)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"no result after {COALESCE_TIMEOUT_SECONDS} seconds")
+    
+    async def _worker(self):
+        while True:
+            # Wait for a first request, then collect more until the batch fills or the window
+            # closes; the request that opens a batch sets its size and window
+            items = [await self.queue.get()]
+            batch_size = items[0]["batch_size"]
+            deadline = self.loop.time() + items[0]["wait_ms"] / 1000
+            while len(items) < batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Only requests for the same model can share a prompt
+            by_model = {}
+            for item in items:
+                by_model.setdefault(item["model"], []).append(item)
+            for model, group in by_model.items():
+                task = asyncio.create_task(self._dispatch(model, group))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+    
+    async def _dispatch(self, model, group):
+        self.batches += 1
+        rows = [(item["company_name"], item["company_description"]) for item in group]
+        # Runs off the script thread, so failures go back through the futures for the caller to show
+        try:
+            results = await asyncio.to_thread(analyze_companies_batch, rows, model, len(rows), True)
+        except Exception as e:
+            results = [e] * len(rows)
+        for item, result in zip(group, results):
+            future = item["future"]
+            # The caller may have timed out and cancelled its wait
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+@st.cache_resource
+def get_coalescer():
+    """Shared request coalescer, so bursts from any session can be merged"""
+    return RequestCoalescer()
+
 # Main interface
 col1, col2 = st.columns([2, 1])
 
@@ -159,12 +981,31 @@ with col1:
     if st.button("🔍 Analyze Company", type="primary"):
         if company_name:
             with st.spinner("Analyzing company..."):
-                analysis = analyze_company(company_name, company_description, selected_model)
+                if coalesce_requests:
+                    try:
+                        analysis = get_coalescer().analyze(
+                            company_name,
+                            company_description,
+                            selected_model,
+                            int(coalesce_batch_size),
+                            coalesce_wait_ms
+                        )
+                        if analysis is None:
+                            raise ValueError("no analysis was returned")
+                    except Exception as e:
+                        st.error(f"Error analyzing company: {str(e)}")
+                        analysis = None
+                else:
+                    stream_placeholder = st.empty()
+                    analysis = analyze_company(
+                        company_name,
+                        company_description,
+                        selected_model,
+                        stream_placeholder,
+                        semantic_threshold if use_semantic_cache else None
+                    )
                 
                 if analysis:
-                    # Store in session state
-                    st.session_state.last_analysis = analysis
-                    
                     # Display results
                     st.success("Analysis complete!")
                     
@@ -192,38 +1033,115 @@ with col1:
                     st.write(analysis.get('reasoning', 'No reasoning provided'))
         else:
             st.warning("Please enter a company name")
-
-with col2:
-    st.header("Team Assignments")
-    st.write("**Current assignment rules:**")
     
-    for sectors, member in TEAM_ASSIGNMENTS.items():
-        st.write(f"• {sectors} → {member}")
+    # Bulk analysis from a CSV upload
+    st.header("Bulk Analysis")
+    uploaded_file = st.file_uploader(
+        "Upload a CSV with a company_name column (and optional company_description column)",
+        type="csv"
+    )
+    if not bulk_mode:
+        bulk_method = st.radio(
+            "Bulk method",
+            ["Batch prompt", "Concurrent requests"],
+            horizontal=True,
+            help="Batch prompt packs several companies into each call; concurrent requests analyze each company separately, in parallel"
+        )
+        if bulk_method == "Batch prompt":
+            batch_size = st.number_input("Companies per API call", min_value=1, max_value=25, value=10)
+        else:
+            max_concurrency = st.number_input("Concurrent requests", min_value=1, max_value=50, value=10)
+    elif not selected_model.startswith("openai/"):
+        st.warning("Bulk mode uses the OpenAI Batch API and needs an openai/ model")
+    
+    if uploaded_file is not None and st.button("📋 Analyze All"):
+        companies = pd.read_csv(uploaded_file)
+        if 'company_name' not in companies.columns:
+            st.warning("CSV must have a company_name column")
+        else:
+            if 'company_description' not in companies.columns:
+                companies['company_description'] = ""
+            companies = companies.dropna(subset=['company_name']).fillna("")
+            rows = [
+                (str(name), str(description))
+                for name, description in zip(companies['company_name'], companies['company_description'])
+            ]
+            
+            if bulk_mode:
+                if not selected_model.startswith("openai/"):
+                    st.error("Bulk mode needs an openai/ model; pick one or turn off Bulk mode")
+                else:
+                    # Only send companies we can't already answer
+                    analyses, pending_rows = [], []
+                    for name, description in rows:
+                        known = lookup_analysis(
+                            get_cache_key(selected_model, name, description), name, description, selected_model
+                        )
+                        if known is not None:
+                            analyses.append(known)
+                        else:
+                            pending_rows.append((name, description))
+                    
+                    if analyses:
+                        st.info(f"{len(analyses)} of {len(rows)} companies were already analyzed")
+                        render_analysis_table(analyses)
+                    if pending_rows:
+                        try:
+                            batch_id = submit_batch_job(pending_rows, selected_model)
+                            st.session_state.batch_job = {"id": batch_id, "rows": pending_rows, "model": selected_model}
+                            st.success(f"Submitted batch {batch_id} with {len(pending_rows)} companies; results arrive within 24 hours")
+                        except Exception as e:
+                            st.error(f"Error submitting batch: {str(e)}")
+            else:
+                with st.spinner(f"Analyzing {len(rows)} companies..."):
+                    if bulk_method == "Batch prompt":
+                        results = analyze_companies_batch(rows, selected_model, int(batch_size))
+                    else:
+                        results = asyncio.run(analyze_companies_concurrent(rows, selected_model, int(max_concurrency)))
+                
+                analyses = [analysis for analysis in results if analysis]
+                st.success(f"Analyzed {len(analyses)} of {len(rows)} companies")
+                render_analysis_table(analyses)
+    
+    # Pending Batch API job
+    if st.session_state.get('batch_job'):
+        batch_job = st.session_state.batch_job
+        st.write(f"**Pending batch:** {batch_job['id']} ({len(batch_job['rows'])} companies)")
+        if st.button("🔄 Check batch status"):
+            try:
+                batch = get_batch_client().batches.retrieve(batch_job['id'])
+                counts = batch.request_counts
+                st.write(f"**Status:** {batch.status}" + (f" ({counts.completed}/{counts.total} done)" if counts else ""))
+                
+                if batch.status == "completed" and not batch.output_file_id:
+                    # Every request failed, so there is only an error file
+                    st.session_state.batch_job = None
+                    st.error(f"Batch completed with no results: {get_batch_error(batch) or 'every request failed'}")
+                elif batch.status == "completed":
+                    results = get_batch_results(batch, batch_job['rows'], batch_job['model'])
+                    analyses = [analysis for analysis in results if analysis]
+                    st.session_state.batch_job = None
+                    st.success(f"Analyzed {len(analyses)} of {len(results)} companies")
+                    render_analysis_table(analyses)
+                elif batch.status in ("failed", "expired", "cancelled"):
+                    st.session_state.batch_job = None
+                    st.error(f"Batch {batch.status}")
+            except Exception as e:
+                st.error(f"Error checking batch: {str(e)}")
 
-# History section
-if 'analysis_history' not in st.session_state:
-    st.session_state.analysis_history = []
-
-# Add to history if we have a recent analysis
-if hasattr(st.session_state, 'last_analysis') and st.session_state.last_analysis:
-    # Check if this analysis is already in history
-    analysis = st.session_state.last_analysis
-    if not any(h.get('company_name') == analysis.get('company_name') for h in st.session_state.analysis_history):
-        all_sectors = analysis.get('primary_sectors', []) + analysis.get('secondary_sectors', [])
-        st.session_state.analysis_history.append({
-            'company_name': analysis.get('company_name'),
-            'sectors': all_sectors,
-            'assigned_to': get_team_assignment(all_sectors),
-            'confidence': analysis.get('confidence', 'Medium')
-        })
+with col2:
+    render_team_rules()
 
 # Display history
-if st.session_state.analysis_history:
-    st.header("📈 Analysis History")
-    for i, item in enumerate(reversed(st.session_state.analysis_history[-10:])):  # Show last 10
-        with st.expander(f"{item['company_name']} → {item['assigned_to']}"):
-            st.write(f"**Sectors:** {', '.join(item['sectors'])}")
-            st.write(f"**Confidence:** {item['confidence']}")
+render_history()
+
+# Coalescing metrics
+if coalesce_requests:
+    coalescer = get_coalescer()
+    if coalescer.submitted:
+        # Batches, not API calls: cached companies make no call and a failed batch falls back to one per company
+        merge_rate = 1 - coalescer.batches / coalescer.submitted
+        st.sidebar.caption(f"Coalesced {coalescer.submitted} requests into {coalescer.batches} batches ({merge_rate:.0%} merged)")
 
 # Instructions
 st.sidebar.header("Instructions")
@@ -233,6 +1151,7 @@ st.sidebar.write("""
 3. Select AI model from dropdown
 4. Click 'Analyze Company'
 5. Review results and team assignment
+6. Or upload a CSV under Bulk Analysis to analyze many companies at once
 """)
 
 st.sidebar.header("API Setup")
@@ -243,6 +1162,8 @@ Create a `.env` file with:
 OPENROUTER_API_KEY=your_key_here
 ```
 
+Bulk mode calls the OpenAI Batch API directly and also needs `OPENAI_API_KEY`.
+
 **For Streamlit Cloud deployment:**
 Add your API key in the Streamlit secrets section as:
 ```